@@ -4,16 +4,272 @@
 import argparse
 import asyncio
 import aiohttp
-import csv
+import email.utils
+import gzip
+import os
+import random
 import re
 import json
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlsplit
 from tqdm import tqdm
 
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser
+    except ImportError:
+        HTMLParser = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+RETRYABLE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, ValueError)
+if httpx is not None:
+    RETRYABLE_ERRORS += (httpx.HTTPError,)
+
 ALPHAFOLD_API = "https://www.alphafold.ebi.ac.uk/api/prediction"
 MGNIFY_WEB = "https://www.ebi.ac.uk/metagenomics/proteins"
 RCSB_PDB_API = "https://data.rcsb.org/graphql"
 
 CONCURRENT_REQUESTS = 20
+QUEUE_DEPTH = 4
+RETRIES = 3
+DNS_CACHE_TTL = 600
+KEEPALIVE_TIMEOUT = 75
+CLEANUP_CLOSED = sys.version_info < (3, 12, 8) or sys.version_info[:3] == (3, 13, 0)
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+
+RETRY_MAX_DELAY = 60
+RETRY_AFTER_MAX_DELAY = 300
+RATE_LIMIT_STATUSES = (429, 503)
+NOT_FOUND_STATUSES = (400, 404, 410)
+
+HTTP2 = False
+RATE_LIMIT = None
+LIMITERS = {}
+SESSION = None
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "foldseek_anno")
+CACHE_TTL = 30 * 24 * 3600
+NEGATIVE_CACHE_TTL = 24 * 3600
+
+CACHE_VERSION = 1
+CACHE = None
+
+PARSE_POOL = None
+
+AF_ACCESSIONS = None
+
+SEQ_MARKER = '<div id="proteinSequenceContainer"'
+PFAM_JSON_MARKER = '<script id="pfam-annotations-data"'
+WS_RE = re.compile(r"\s+")
+PFAM_ROW_RE = re.compile(r'(PF\d{5}).*?<td[^>]*>([^<]+)</td>', re.S)
+IPR_GO_ROW_RE = re.compile(r'(?:(IPR\d{6})|(GO:\d{7})).*?<td[^>]*>([^<]+)</td>')
+ACCESSION_RE = re.compile(r'PF\d{5}|IPR\d{6}|GO:\d{7}')
+
+PDB_BATCH_SIZE = 50
+AF_TARGET_RE = re.compile(r"AF-(.+?)-F1")
+TARGET_CACHE_SIZE = 1 << 16
+
+SCAN_BLOCK = 1 << 20
+ROW_BLOCKS = 8
+WRITE_BUFFER = 1 << 20
+TAB_KILL = str.maketrans({"\t": " ", "\n": " ", "\r": " "})
+PDB_ENTRY_FIELDS = """
+            rcsb_id
+            struct { title }
+            polymer_entities {
+              rcsb_polymer_entity { pdbx_description }
+              pfams {
+                rcsb_pfam_accession
+                rcsb_pfam_identifier
+              }
+            }
+"""
+PDB_ENTRY_QUERY = """
+        query($id: String!) {
+          entry(entry_id: $id) {""" + PDB_ENTRY_FIELDS + """          }
+        }
+"""
+PDB_ENTRIES_QUERY = """
+        query($ids: [String!]!) {
+          entries(entry_ids: $ids) {""" + PDB_ENTRY_FIELDS + """          }
+        }
+"""
+
+
+def load_accessions(path):
+    global AF_ACCESSIONS
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        AF_ACCESSIONS = frozenset(
+            line.split(",", 1)[0].strip() for line in f if line.strip()
+        )
+
+
+def open_cache(cache_dir):
+    global CACHE
+
+    os.makedirs(cache_dir, exist_ok=True)
+    CACHE = sqlite3.connect(os.path.join(cache_dir, "annotations.sqlite"), isolation_level=None)
+    CACHE.execute("PRAGMA journal_mode=WAL")
+    CACHE.execute("PRAGMA synchronous=NORMAL")
+    CACHE.execute(
+        "CREATE TABLE IF NOT EXISTS annotations ("
+        "db TEXT, id TEXT, value TEXT, expires REAL, PRIMARY KEY (db, id))"
+    )
+    if CACHE.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+        CACHE.execute("DELETE FROM annotations")
+        CACHE.execute("PRAGMA user_version = {}".format(CACHE_VERSION))
+    CACHE.execute("DELETE FROM annotations WHERE expires < ?", (time.time(),))
+
+
+def close_cache():
+    global CACHE
+
+    if CACHE is not None:
+        CACHE.close()
+    CACHE = None
+
+
+def cache_get(database, uid):
+    if CACHE is None:
+        return None
+
+    row = CACHE.execute(
+        "SELECT value, expires FROM annotations WHERE db = ? AND id = ?",
+        (database, uid)
+    ).fetchone()
+    if row is None or row[1] < time.time():
+        return None
+    return json_loads(row[0])
+
+
+def cache_set(database, uid, value, ttl=None):
+    if CACHE is None:
+        return
+
+    if ttl is None:
+        ttl = CACHE_TTL
+
+    CACHE.execute(
+        "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)",
+        (database, uid, json.dumps(value), time.time() + ttl)
+    )
+
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def throttle(url):
+    if RATE_LIMIT is None:
+        return
+
+    host = urlsplit(url).netloc
+    if host not in LIMITERS:
+        LIMITERS[host] = TokenBucket(RATE_LIMIT)
+    await LIMITERS[host].acquire()
+
+
+class RateLimited(RuntimeError):
+    def __init__(self, status, delay):
+        super().__init__("HTTP {}".format(status))
+        self.delay = delay
+
+
+class MalformedResponse(Exception):
+    pass
+
+
+def check_shape(value, kind, what):
+    if not isinstance(value, kind):
+        raise MalformedResponse("{} is {}".format(what, type(value).__name__))
+    return value
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def check_rate_limit(r):
+    if r.status in RATE_LIMIT_STATUSES:
+        raise RateLimited(r.status, parse_retry_after(r.headers.get("Retry-After")))
+
+
+def describe_error(e):
+    if isinstance(e, asyncio.TimeoutError):
+        return "Timed out"
+    if isinstance(e, MalformedResponse):
+        return "Malformed response: {}".format(e)
+    return str(e) or type(e).__name__
+
+
+def retry_delay(attempt, error, base):
+    delay = getattr(error, "delay", None)
+    if delay is not None:
+        return min(delay, RETRY_AFTER_MAX_DELAY)
+    return min(RETRY_MAX_DELAY, base * 2 ** attempt) + random.uniform(0, 0.5 * base)
 
 
 async def fetch_alphafold_description(session, uniprot_id, semaphore, retries=3):
@@ -22,95 +278,292 @@ async def fetch_alphafold_description(session, uniprot_id, semaphore, retries=3)
     for attempt in range(retries):
         try:
             async with semaphore:
-                async with session.get(url, timeout=30) as r:
+                await throttle(url)
+                async with session.get(url) as r:
+                    check_rate_limit(r)
+                    if r.status in NOT_FOUND_STATUSES:
+                        desc = "HTTP {}".format(r.status)
+                        cache_set("alphafold", uniprot_id, desc, NEGATIVE_CACHE_TTL)
+                        return uniprot_id, desc
+
                     if r.status != 200:
-                        return uniprot_id, "HTTP {}".format(r.status)
+                        raise RuntimeError("HTTP {}".format(r.status))
 
-                    data = await r.json()
+                    data = json_loads(await r.read())
                     if isinstance(data, list) and data:
-                        return uniprot_id, data[0].get("uniprotDescription", "No description found")
+                        desc = check_shape(data[0], dict, "prediction").get(
+                            "uniprotDescription", "No description found")
+                        cache_set("alphafold", uniprot_id, desc)
+                        return uniprot_id, desc
+
+                    cache_set("alphafold", uniprot_id, "No data", NEGATIVE_CACHE_TTL)
                     return uniprot_id, "No data"
-        except Exception as e:
+        except MalformedResponse as e:
+            return uniprot_id, "Failed: {}".format(describe_error(e))
+        except RETRYABLE_ERRORS as e:
             if attempt == retries - 1:
-                return uniprot_id, "Failed: {}".format(e)
-            await asyncio.sleep(1)
+                return uniprot_id, "Failed: {}".format(describe_error(e))
+            await asyncio.sleep(retry_delay(attempt, e, 1))
+
+
+def parse_pdb_entry(pdb_id, entry):
+    ann = {
+        "pdb_id": pdb_id,
+        "title": "No title",
+        "pfam": [],
+        "description": "No description"
+    }
+
+    if not entry:
+        return ann
+
+    check_shape(entry, dict, "entry")
+    struct = check_shape(entry.get("struct") or {}, dict, "struct")
+    if struct.get("title"):
+        ann["title"] = struct["title"]
+
+    for ent in check_shape(entry.get("polymer_entities") or [], list, "polymer_entities"):
+        check_shape(ent, dict, "polymer entity")
+        info = check_shape(ent.get("rcsb_polymer_entity") or {}, dict, "rcsb_polymer_entity")
+        if info.get("pdbx_description"):
+            ann["description"] = info["pdbx_description"]
+
+        for pf in check_shape(ent.get("pfams") or [], list, "pfams"):
+            check_shape(pf, dict, "pfam")
+            ann["pfam"].append((
+                pf.get("rcsb_pfam_accession", ""),
+                pf.get("rcsb_pfam_identifier", "")
+            ))
+
+    return ann
+
+
+def pdb_failure(pdb_id, e):
+    return {
+        "pdb_id": pdb_id,
+        "title": "Failed",
+        "pfam": [],
+        "description": describe_error(e),
+        "error": describe_error(e)
+    }
 
 
 async def fetch_pdb_annotations(session, pdb_id, semaphore, retries=3):
     query = {
-        "query": """
-        query($id: String!) {
-          entry(entry_id: $id) {
-            struct { title }
-            polymer_entities {
-              rcsb_polymer_entity { pdbx_description }
-              pfams {
-                rcsb_pfam_accession
-                rcsb_pfam_identifier
-                rcsb_pfam_description
-              }
-            }
-          }
-        }
-        """,
+        "query": PDB_ENTRY_QUERY,
         "variables": {"id": pdb_id.upper()}
     }
 
     for attempt in range(retries):
         try:
             async with semaphore:
-                async with session.post(RCSB_PDB_API, json=query, timeout=30) as r:
-                    if r.status == 404:
-                        return pdb_id, {
+                await throttle(RCSB_PDB_API)
+                async with session.post(RCSB_PDB_API, json=query) as r:
+                    check_rate_limit(r)
+                    if r.status in NOT_FOUND_STATUSES:
+                        ann = {
                             "pdb_id": pdb_id,
                             "title": "Not found",
                             "pfam": [],
                             "description": "Not found"
                         }
+                        cache_set("pdb", pdb_id, ann, NEGATIVE_CACHE_TTL)
+                        return pdb_id, ann
 
                     if r.status != 200:
                         raise RuntimeError("HTTP {}".format(r.status))
 
-                    raw = await r.json()
-                    entry = raw.get("data", {}).get("entry")
+                    raw = check_shape(json_loads(await r.read()), dict, "response")
+                    entry = check_shape(raw.get("data"), dict, "data").get("entry")
+                    ann = parse_pdb_entry(pdb_id, entry)
+                    cache_set("pdb", pdb_id, ann, CACHE_TTL if entry else NEGATIVE_CACHE_TTL)
+                    return pdb_id, ann
+
+        except MalformedResponse as e:
+            return pdb_id, pdb_failure(pdb_id, e)
+        except RETRYABLE_ERRORS as e:
+            if attempt == retries - 1:
+                return pdb_id, pdb_failure(pdb_id, e)
+            await asyncio.sleep(retry_delay(attempt, e, 2))
 
-                    ann = {
-                        "pdb_id": pdb_id,
-                        "title": "No title",
-                        "pfam": [],
-                        "description": "No description"
-                    }
 
-                    if not entry:
-                        return pdb_id, ann
+async def fetch_pdb_annotations_batch(session, pdb_ids, semaphore, retries=3):
+    query = {
+        "query": PDB_ENTRIES_QUERY,
+        "variables": {"ids": [i.upper() for i in pdb_ids]}
+    }
+
+    for attempt in range(retries):
+        try:
+            async with semaphore:
+                await throttle(RCSB_PDB_API)
+                async with session.post(RCSB_PDB_API, json=query) as r:
+                    check_rate_limit(r)
+                    status = r.status
+                    if status == 200:
+                        raw = json_loads(await r.read())
+
+            if status >= 500 or status in NOT_FOUND_STATUSES:
+                break
+
+            if status != 200:
+                raise RuntimeError("HTTP {}".format(status))
+
+            data = check_shape(raw, dict, "response").get("data")
+            if not isinstance(data, dict):
+                break
+
+            entries = {}
+            for entry in check_shape(data.get("entries") or [], list, "entries"):
+                if entry is None:
+                    continue
+                rcsb_id = check_shape(entry, dict, "entry").get("rcsb_id")
+                if rcsb_id:
+                    entries[check_shape(rcsb_id, str, "rcsb_id").lower()] = entry
+
+            # Parse everything before caching so a malformed entry leaves
+            # nothing behind when the batch falls back to single queries.
+            results = [(i, parse_pdb_entry(i, entries.get(i.lower()))) for i in pdb_ids]
+            for pdb_id, ann in results:
+                ttl = CACHE_TTL if entries.get(pdb_id.lower()) else NEGATIVE_CACHE_TTL
+                cache_set("pdb", pdb_id, ann, ttl)
+            return results
+
+        except MalformedResponse:
+            break
+        except RETRYABLE_ERRORS as e:
+            if attempt == retries - 1:
+                return [(pdb_id, pdb_failure(pdb_id, e)) for pdb_id in pdb_ids]
+            await asyncio.sleep(retry_delay(attempt, e, 2))
+
+    return await asyncio.gather(*[
+        fetch_pdb_annotations(session, i, semaphore, retries) for i in pdb_ids
+    ])
+
+
+def parse_table_annotations(tree):
+    rows = []
+    for tr in tree.css("tr"):
+        cells = [td.text(strip=True) for td in tr.css("td")]
+        for i, cell in enumerate(cells[:-1]):
+            for acc in ACCESSION_RE.findall(cell):
+                rows.append((acc, cells[i + 1]))
+    return rows
+
+
+def slice_block(html, marker, end_tag):
+    start = html.find(marker)
+    if start < 0:
+        return None
+
+    start = html.find(">", start) + 1
+    end = html.find(end_tag, start)
+    if not start or end < 0:
+        return None
+    return html[start:end]
+
+
+def json_array(text):
+    if text is None:
+        return None
+
+    text = text.strip()
+    if text[:1] == "[" and text[-1:] == "]":
+        return text
+    return None
+
+
+def parse_mgnify_html(mgyp_id, html):
+    ann = {
+        "mgyp_id": mgyp_id,
+        "sequence_length": "N/A",
+        "pfam": [],
+        "interpro": [],
+        "go_terms": [],
+        "description": "No description"
+    }
 
-                    if entry.get("struct", {}).get("title"):
-                        ann["title"] = entry["struct"]["title"]
+    pfam_payload = None
+    table_rows = []
 
-                    for ent in entry.get("polymer_entities", []):
-                        desc = ent.get("rcsb_polymer_entity", {}).get("pdbx_description")
-                        if desc:
-                            ann["description"] = desc
+    # The sequence block is always sliced so both paths count the same
+    # characters; only the Pfam script and table rows use selectolax.
+    seq_text = slice_block(html, SEQ_MARKER, "</div>")
 
-                        for pf in ent.get("pfams") or []:
-                            ann["pfam"].append({
-                                "accession": pf.get("rcsb_pfam_accession", ""),
-                                "name": pf.get("rcsb_pfam_identifier", ""),
-                                "description": pf.get("rcsb_pfam_description", "")
-                            })
+    if HTMLParser is not None:
+        tree = HTMLParser(html)
 
-                    return pdb_id, ann
+        node = tree.css_first("script#pfam-annotations-data")
+        if node is not None:
+            pfam_payload = json_array(node.text())
+
+        table_rows = parse_table_annotations(tree)
+    else:
+        pfam_payload = json_array(slice_block(html, PFAM_JSON_MARKER, "</script>"))
+
+    if seq_text is not None:
+        ann["sequence_length"] = len(WS_RE.sub("", seq_text))
+
+    if pfam_payload:
+        for p in json_loads(pfam_payload):
+            if isinstance(p, dict):
+                ann["pfam"].append((p.get("accession", ""), p.get("name", "")))
+
+    use_pfam_rows = not ann["pfam"]
+
+    # Fall back to the regexes per annotation type, so a page whose table
+    # only yielded GO terms still gets its InterPro rows scanned.
+    found = {acc[:2] for acc, _ in table_rows}
+    if use_pfam_rows and "PF" not in found:
+        table_rows.extend(PFAM_ROW_RE.findall(html))
+    if "IP" not in found or "GO" not in found:
+        for ipr, go, name in IPR_GO_ROW_RE.findall(html):
+            if ipr and "IP" not in found:
+                table_rows.append((ipr, name))
+            elif go and "GO" not in found:
+                table_rows.append((go, name))
+
+    for acc, name in table_rows:
+        if acc.startswith("PF"):
+            if use_pfam_rows:
+                ann["pfam"].append((acc, name.strip()))
+        elif acc.startswith("IPR"):
+            ann["interpro"].append((acc, name.strip()))
+        else:
+            ann["go_terms"].append((acc, name.strip()))
+
+    return ann
+
+
+def parse_mgnify_page(mgyp_id, raw):
+    return parse_mgnify_html(mgyp_id, raw.decode("utf-8", errors="replace"))
+
+
+def open_parse_pool(workers):
+    global PARSE_POOL
+
+    if workers > 0:
+        PARSE_POOL = ProcessPoolExecutor(max_workers=workers)
 
-        except Exception as e:
-            if attempt == retries - 1:
-                return pdb_id, {
-                    "pdb_id": pdb_id,
-                    "title": "Failed",
-                    "pfam": [],
-                    "description": str(e),
-                    "error": str(e)
-                }
-            await asyncio.sleep(2)
+
+def close_parse_pool():
+    global PARSE_POOL
+
+    if PARSE_POOL is not None:
+        PARSE_POOL.shutdown()
+    PARSE_POOL = None
+
+
+def mgnify_failure(mgyp_id, e):
+    return {
+        "mgyp_id": mgyp_id,
+        "sequence_length": "N/A",
+        "pfam": [],
+        "interpro": [],
+        "go_terms": [],
+        "description": describe_error(e),
+        "error": describe_error(e)
+    }
 
 
 async def fetch_mgnify_from_web(session, mgyp_id, semaphore, retries=3):
@@ -119,9 +572,11 @@ async def fetch_mgnify_from_web(session, mgyp_id, semaphore, retries=3):
     for attempt in range(retries):
         try:
             async with semaphore:
-                async with session.get(url, timeout=30) as r:
-                    if r.status == 404:
-                        return mgyp_id, {
+                await throttle(url)
+                async with session.get(url) as r:
+                    check_rate_limit(r)
+                    if r.status in NOT_FOUND_STATUSES:
+                        ann = {
                             "mgyp_id": mgyp_id,
                             "sequence_length": "N/A",
                             "pfam": [],
@@ -129,235 +584,400 @@ async def fetch_mgnify_from_web(session, mgyp_id, semaphore, retries=3):
                             "go_terms": [],
                             "description": "Not found"
                         }
+                        cache_set("mgnify", mgyp_id, ann, NEGATIVE_CACHE_TTL)
+                        return mgyp_id, ann
 
                     if r.status != 200:
                         raise RuntimeError("HTTP {}".format(r.status))
 
-                    html = await r.text()
-
-                    ann = {
-                        "mgyp_id": mgyp_id,
-                        "sequence_length": "N/A",
-                        "pfam": [],
-                        "interpro": [],
-                        "go_terms": [],
-                        "description": "No description"
-                    }
-
-                    seq = re.search(r'<div id="proteinSequenceContainer".*?>(.*?)</div>', html, re.S)
-                    if seq:
-                        ann["sequence_length"] = len(re.sub(r"\s+", "", seq.group(1)))
-
-                    pfam_json = re.search(
-                        r'<script id="pfam-annotations-data".*?>(\[.*?\])</script>',
-                        html,
-                        re.S
-                    )
-
-                    if pfam_json:
-                        for p in json.loads(pfam_json.group(1)):
-                            ann["pfam"].append({
-                                "accession": p.get("accession", ""),
-                                "name": p.get("name", ""),
-                                "description": ""
-                            })
-
-                    if not ann["pfam"]:
-                        rows = re.findall(r'(PF\d{5}).*?<td.*?>([^<]+)</td>', html, re.S)
-                        for pf, name in rows:
-                            ann["pfam"].append({
-                                "accession": pf,
-                                "name": name.strip(),
-                                "description": ""
-                            })
-
-                    iprs = re.findall(r'(IPR\d{6}).*?<td.*?>([^<]+)</td>', html)
-                    for ipr, name in iprs:
-                        ann["interpro"].append({
-                            "accession": ipr,
-                            "name": name.strip(),
-                            "type": ""
-                        })
-
-                    gos = re.findall(r'(GO:\d{7}).*?<td.*?>([^<]+)</td>', html)
-                    for go, name in gos:
-                        ann["go_terms"].append({
-                            "accession": go,
-                            "name": name.strip(),
-                            "category": ""
-                        })
-
-                    return mgyp_id, ann
+                    raw = await r.read()
 
-        except Exception as e:
+            if PARSE_POOL is not None:
+                loop = asyncio.get_running_loop()
+                ann = await loop.run_in_executor(PARSE_POOL, parse_mgnify_page, mgyp_id, raw)
+            else:
+                ann = parse_mgnify_page(mgyp_id, raw)
+
+            cache_set("mgnify", mgyp_id, ann)
+            return mgyp_id, ann
+
+        except RETRYABLE_ERRORS as e:
             if attempt == retries - 1:
-                return mgyp_id, {
-                    "mgyp_id": mgyp_id,
-                    "sequence_length": "N/A",
-                    "pfam": [],
-                    "interpro": [],
-                    "go_terms": [],
-                    "description": str(e),
-                    "error": str(e)
-                }
-            await asyncio.sleep(2)
+                return mgyp_id, mgnify_failure(mgyp_id, e)
+            await asyncio.sleep(retry_delay(attempt, e, 2))
+
+
+class HTTP2Response:
+    def __init__(self, client, method, url, kwargs):
+        self.client = client
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.response = None
+
+    async def __aenter__(self):
+        request = self.client.build_request(self.method, self.url, **self.kwargs)
+        self.response = await self.client.send(request, stream=True)
+        self.status = self.response.status_code
+        self.headers = self.response.headers
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.response.aclose()
+
+    async def read(self):
+        return await self.response.aread()
+
+
+class HTTP2Session:
+    def __init__(self):
+        self.client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=CONCURRENT_REQUESTS,
+                max_keepalive_connections=CONCURRENT_REQUESTS,
+                keepalive_expiry=KEEPALIVE_TIMEOUT
+            ),
+            timeout=httpx.Timeout(30.0, connect=10.0, pool=None)
+        )
+
+    @property
+    def closed(self):
+        return self.client.is_closed
+
+    def get(self, url, **kwargs):
+        return HTTP2Response(self.client, "GET", url, kwargs)
+
+    def post(self, url, **kwargs):
+        return HTTP2Response(self.client, "POST", url, kwargs)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def get_session():
+    global SESSION
+
+    if HTTP2 and (SESSION is None or SESSION.closed):
+        SESSION = HTTP2Session()
+
+    elif SESSION is None or SESSION.closed:
+        resolver = aiohttp.AsyncResolver() if aiodns is not None else None
+        conn = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=CONCURRENT_REQUESTS,
+            resolver=resolver,
+            use_dns_cache=True,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            enable_cleanup_closed=CLEANUP_CLOSED
+        )
+        SESSION = aiohttp.ClientSession(connector=conn, timeout=HTTP_TIMEOUT)
+
+    return SESSION
+
+
+async def close_session():
+    global SESSION
+
+    if SESSION is not None and not SESSION.closed:
+        await SESSION.close()
+    SESSION = None
+
+
+class AnnotationFetcher:
+    def __init__(self, database, session, semaphore, pbar):
+        self.database = database
+        self.session = session
+        self.semaphore = semaphore
+        self.pbar = pbar
+        self.pending = {}
+        self.queue = None
+        self.workers = []
+
+    def start(self, n_workers):
+        depth = PDB_BATCH_SIZE if self.database == "pdb" else QUEUE_DEPTH
+        self.queue = asyncio.Queue(maxsize=n_workers * depth)
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(n_workers)]
+
+    async def request(self, uid):
+        if uid in self.pending:
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[uid] = fut
+        self.pbar.total = len(self.pending)
+
+        if self.database == "alphafold" and AF_ACCESSIONS is not None and uid not in AF_ACCESSIONS:
+            cached = "Not in AlphaFold"
+        else:
+            cached = cache_get(self.database, uid)
+
+        if cached is not None:
+            fut.set_result(cached)
+            self.pbar.update(1)
+        else:
+            await self.queue.put(uid)
+
+    async def worker(self):
+        while True:
+            ids = [await self.queue.get()]
+            if self.database == "pdb":
+                while len(ids) < PDB_BATCH_SIZE and not self.queue.empty():
+                    ids.append(self.queue.get_nowait())
+            await self.resolve(ids)
+
+    async def resolve(self, ids):
+        try:
+            if self.database == "alphafold":
+                done = [await fetch_alphafold_description(
+                    self.session, ids[0], self.semaphore, RETRIES
+                )]
+            elif self.database == "mgnify":
+                done = [await fetch_mgnify_from_web(self.session, ids[0], self.semaphore, RETRIES)]
+            else:
+                done = await fetch_pdb_annotations_batch(self.session, ids, self.semaphore, RETRIES)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            for uid in ids:
+                self.pending[uid].set_exception(e)
+            return
+
+        for uid, ann in done:
+            self.pending[uid].set_result(ann)
+        self.pbar.update(len(done))
 
+    def cancel(self):
+        for task in self.workers:
+            task.cancel()
 
-def extract_unique_ids(m8_file, database):
-    ids = set()
 
-    with open(m8_file) as f:
-        for line in f:
-            cols = line.rstrip().split("\t")
-            if len(cols) < 2:
-                continue
+@lru_cache(maxsize=TARGET_CACHE_SIZE)
+def extract_target_id(database, target):
+    if database == "alphafold":
+        m = AF_TARGET_RE.match(target)
+        if m:
+            return m.group(1), True
+        return target.split("-F1")[0].replace("AF-", ""), False
 
-            target = cols[1]
+    if database == "mgnify":
+        start = target.find("MGYP")
+        mg = target[start:] if start >= 0 else target
+        return mg.partition(".")[0].partition("_")[0], start >= 0
 
-            if database == "alphafold" and target.startswith("AF-") and "-F1" in target:
-                ids.add(target.split("-F1")[0].replace("AF-", ""))
+    pid = target.split("-")[0].split(".")[0].lower()
+    return pid, len(pid) == 4
 
-            elif database == "mgnify" and "MGYP" in target:
-                mg = target[target.find("MGYP"):]
-                mg = mg.split(".")[0].split("_")[0]
-                ids.add(mg)
 
-            elif database == "pdb":
-                pid = target.split("-")[0].split(".")[0].lower()
-                if len(pid) == 4:
-                    ids.add(pid)
+async def scan_m8(m8_file, database, fetcher, rows):
+    pending = fetcher.pending
 
-    return sorted(ids)
+    try:
+        with open(m8_file) as f:
+            while True:
+                lines = f.readlines(SCAN_BLOCK)
+                if not lines:
+                    break
 
+                block = []
+                for line in lines:
+                    line = line.rstrip()
+                    if line.count("\t") < 11:
+                        continue
 
-async def fetch_all_annotations(ids, database):
+                    uid, valid = extract_target_id(database, line.split("\t", 2)[1])
+                    if valid and uid not in pending:
+                        await fetcher.request(uid)
+
+                    block.append((line, uid))
+
+                await rows.put(block)
+    finally:
+        # Always end the stream so the writer stops; annotate_m8 then
+        # re-raises the reader's error.
+        await rows.put(None)
+
+
+async def annotate_m8(m8_file, out_file, database):
+    rows = asyncio.Queue(maxsize=ROW_BLOCKS)
     sem = asyncio.Semaphore(CONCURRENT_REQUESTS)
-    conn = aiohttp.TCPConnector(limit=CONCURRENT_REQUESTS)
 
-    async with aiohttp.ClientSession(connector=conn) as session:
-        if database == "alphafold":
-            tasks = [fetch_alphafold_description(session, i, sem) for i in ids]
-        elif database == "mgnify":
-            tasks = [fetch_mgnify_from_web(session, i, sem) for i in ids]
-        else:
-            tasks = [fetch_pdb_annotations(session, i, sem) for i in ids]
+    with tqdm(total=0, unit="id", desc="Fetching {}".format(database)) as pbar:
+        fetcher = AnnotationFetcher(database, get_session(), sem, pbar)
+        fetcher.start(CONCURRENT_REQUESTS)
+        reader = asyncio.ensure_future(scan_m8(m8_file, database, fetcher, rows))
+
+        try:
+            await merge_annotations(rows, fetcher, out_file, database)
+            await reader
+        finally:
+            reader.cancel()
+            fetcher.cancel()
+
+    return len(fetcher.pending)
 
-        results = {}
-        for f in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
-            k, v = await f
-            results[k] = v
 
-        return results
+async def annotate(m8_file, out_file, database):
+    try:
+        return await annotate_m8(m8_file, out_file, database)
+    finally:
+        await close_session()
 
 
 def format_ann(lst):
     if not lst:
         return "None"
-    return "; ".join("{} ({})".format(x["accession"], x["name"]) for x in lst)
-
-
-def merge_alphafold_annotations(m8, ann, out):
-    with open(m8) as inp, open(out, "w", newline="") as outp:
-        w = csv.writer(outp, delimiter="\t")
-        w.writerow([
-            "Query_ID", "Target_ID", "UniProt_ID", "Identity", "Length",
-            "Mismatches", "GapOpen", "Q_start", "Q_end", "S_start", "S_end",
-            "E-value", "BitScore", "Description"
-        ])
-
-        for line in inp:
-            p = line.rstrip().split("\t")
-            if len(p) < 12:
-                continue
-
-            tid = p[1]
-            uid = tid.split("-F1")[0].replace("AF-", "")
-            desc = ann.get(uid, "No description found")
-            w.writerow(p[:1] + [tid, uid] + p[2:] + [desc])
-
-
-def merge_mgnify_annotations(m8, ann, out):
-    with open(m8) as inp, open(out, "w", newline="") as outp:
-        w = csv.writer(outp, delimiter="\t")
-        w.writerow([
-            "Query_ID", "Target_ID", "MGYP_ID", "Identity", "Length",
-            "Mismatches", "GapOpen", "Q_start", "Q_end", "S_start", "S_end",
-            "E-value", "BitScore", "Seq_Length", "Pfam_Annotations",
-            "InterPro_Annotations", "GO_Terms", "Description"
-        ])
-
-        for line in inp:
-            p = line.rstrip().split("\t")
-            if len(p) < 12:
-                continue
-
-            t = p[1]
-            mg = t[t.find("MGYP"):] if "MGYP" in t else t
-            mg = mg.split(".")[0].split("_")[0]
-
-            a = ann.get(mg, {})
-            w.writerow(
-                p[:1] + [t, mg] + p[2:] + [
-                    a.get("sequence_length", "N/A"),
-                    format_ann(a.get("pfam", [])),
-                    format_ann(a.get("interpro", [])),
-                    format_ann(a.get("go_terms", [])),
-                    a.get("description", "No description")
-                ]
-            )
-
-
-def merge_pdb_annotations(m8, ann, out):
-    with open(m8) as inp, open(out, "w", newline="") as outp:
-        w = csv.writer(outp, delimiter="\t")
-        w.writerow([
-            "Query_ID", "Target_ID", "PDB_ID", "Identity", "Length",
-            "Mismatches", "GapOpen", "Q_start", "Q_end", "S_start", "S_end",
-            "E-value", "BitScore", "Pfam_Annotations", "Title", "Description"
-        ])
-
-        for line in inp:
-            p = line.rstrip().split("\t")
-            if len(p) < 12:
-                continue
-
-            t = p[1]
-            pid = t.split("-")[0].split(".")[0].lower()
-            a = ann.get(pid, {})
-            w.writerow(
-                p[:1] + [t, pid] + p[2:] + [
-                    format_ann(a.get("pfam", [])),
-                    a.get("title", "No title"),
-                    a.get("description", "No description")
-                ]
-            )
+    return "; ".join("{} ({})".format(acc, name) for acc, name in lst)
+
+
+def alphafold_fields(a):
+    return [a]
+
+
+def mgnify_fields(a):
+    return [
+        a.get("sequence_length", "N/A"),
+        format_ann(a.get("pfam", [])),
+        format_ann(a.get("interpro", [])),
+        format_ann(a.get("go_terms", [])),
+        a.get("description", "No description")
+    ]
+
+
+def pdb_fields(a):
+    return [
+        format_ann(a.get("pfam", [])),
+        a.get("title", "No title"),
+        a.get("description", "No description")
+    ]
+
+
+M8_COLUMNS = [
+    "Identity", "Length", "Mismatches", "GapOpen", "Q_start", "Q_end",
+    "S_start", "S_end", "E-value", "BitScore"
+]
+
+MERGE_SPECS = {
+    "alphafold": (
+        ["Query_ID", "Target_ID", "UniProt_ID"] + M8_COLUMNS + ["Description"],
+        "No description found",
+        alphafold_fields
+    ),
+    "mgnify": (
+        ["Query_ID", "Target_ID", "MGYP_ID"] + M8_COLUMNS + [
+            "Seq_Length", "Pfam_Annotations", "InterPro_Annotations", "GO_Terms", "Description"
+        ],
+        {},
+        mgnify_fields
+    ),
+    "pdb": (
+        ["Query_ID", "Target_ID", "PDB_ID"] + M8_COLUMNS + [
+            "Pfam_Annotations", "Title", "Description"
+        ],
+        {},
+        pdb_fields
+    )
+}
+
+
+async def merge_annotations(rows, ann, out, database):
+    header, default, fields = MERGE_SPECS[database]
+    pending = ann.pending
+    tails = {}
+    loop = asyncio.get_running_loop()
+    writing = None
+
+    with open(out, "w", newline="", buffering=WRITE_BUFFER) as outp:
+        outp.write("\t".join(header) + "\n")
+
+        try:
+            while True:
+                block = await rows.get()
+                if block is None:
+                    break
+
+                batch = []
+                for line, uid in block:
+                    tail = tails.get(uid)
+                    if tail is None:
+                        fut = pending.get(uid)
+                        a = default if fut is None else await fut
+                        tail = "\t".join(str(f).translate(TAB_KILL) for f in fields(a)) + "\n"
+                        tails[uid] = tail
+
+                    query, target, rest = line.split("\t", 2)
+                    batch.append("\t".join((query, target, uid, rest, tail)))
+
+                # Hand the block to a thread so disk writes overlap with
+                # fetching and formatting the next block.
+                if writing is not None:
+                    await writing
+                writing = loop.run_in_executor(None, outp.write, "".join(batch))
+
+            if writing is not None:
+                await writing
+        finally:
+            if writing is not None and not writing.done():
+                await asyncio.wait([writing])
 
 
 def main():
+    global CONCURRENT_REQUESTS, RETRIES, HTTP2, RATE_LIMIT, CACHE_TTL, NEGATIVE_CACHE_TTL
+
     ap = argparse.ArgumentParser()
     ap.add_argument("-i", "--input", required=True)
     ap.add_argument("-o", "--output", required=True)
     ap.add_argument("-d", "--database", choices=["alphafold", "mgnify", "pdb"], required=True)
     ap.add_argument("-c", "--concurrent", type=int, default=20)
+    ap.add_argument("-r", "--retries", type=int, default=RETRIES)
+    ap.add_argument("--cache-dir", default=CACHE_DIR)
+    ap.add_argument("--no-cache", action="store_true")
+    ap.add_argument("--cache-days", type=float, default=CACHE_TTL / 86400)
+    ap.add_argument("--http2", action="store_true")
+    ap.add_argument("--rate", type=float)
+    ap.add_argument("--af-accessions")
+    ap.add_argument("--parse-workers", type=int, default=(os.cpu_count() or 1) - 1)
     args = ap.parse_args()
+    if args.rate is not None and args.rate <= 0:
+        ap.error("--rate must be greater than 0")
 
-    global CONCURRENT_REQUESTS
     CONCURRENT_REQUESTS = args.concurrent
-
-    ids = extract_unique_ids(args.input, args.database)
-    if not ids:
+    RETRIES = max(1, args.retries)
+    RATE_LIMIT = args.rate
+    CACHE_TTL = args.cache_days * 86400
+    NEGATIVE_CACHE_TTL = min(NEGATIVE_CACHE_TTL, CACHE_TTL)
+
+    if args.http2 and (httpx is None or h2 is None):
+        raise SystemExit("--http2 requires httpx and h2: pip install 'httpx[http2]'")
+    HTTP2 = args.http2
+
+    if args.af_accessions and args.database == "alphafold":
+        load_accessions(args.af_accessions)
+
+    if not args.no_cache:
+        open_cache(args.cache_dir)
+
+    if args.database == "mgnify":
+        open_parse_pool(args.parse_workers)
+
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    try:
+        n_ids = asyncio.run(annotate(args.input, args.output, args.database))
+    except BaseException:
+        if os.path.exists(args.output):
+            os.remove(args.output)
+        raise
+    finally:
+        close_parse_pool()
+        close_cache()
+
+    if not n_ids:
+        os.remove(args.output)
         raise SystemExit("No valid IDs found")
 
-    loop = asyncio.get_event_loop()
-    ann = loop.run_until_complete(fetch_all_annotations(ids, args.database))
-
-    if args.database == "alphafold":
-        merge_alphafold_annotations(args.input, ann, args.output)
-    elif args.database == "mgnify":
-        merge_mgnify_annotations(args.input, ann, args.output)
-    else:
-        merge_pdb_annotations(args.input, ann, args.output)
-
 
 if __name__ == "__main__":
     main()